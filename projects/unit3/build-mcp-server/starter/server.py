@@ -5,20 +5,40 @@ Module 1: Basic MCP Server - Starter Code
 """
 # 测试MCP服务是否有用
 
+import asyncio
 import json
-import subprocess
+from collections import OrderedDict
 from pathlib import Path
-from typing import Optional
+from typing import AsyncIterable, AsyncIterator, Iterable, Optional
 
+import pygit2
 from mcp.server.fastmcp import FastMCP
+from mcp.types import ListRootsResult
 import os
 
+# orjson serializes large responses (the diff) much faster; fall back to the stdlib
+try:
+    import orjson
+
+    def _dumps(obj) -> str:
+        try:
+            return orjson.dumps(obj, option=orjson.OPT_INDENT_2).decode()
+        except orjson.JSONEncodeError:
+            # orjson rejects strings the stdlib accepts, such as lone surrogates
+            return json.dumps(obj, indent=2)
+except ImportError:
+    def _dumps(obj) -> str:
+        return json.dumps(obj, indent=2)
+
 # Initialize the FastMCP server
 mcp = FastMCP("pr-agent")
 
 # PR template directory (shared across all modules)
 TEMPLATES_DIR = Path(__file__).parent.parent.parent / "templates"
 
+# Directory of this file, reported in debug output
+_SERVER_DIR = str(Path(__file__).parent)
+
 # Default PR templates
 DEFAULT_TEMPLATES = {
     "bug.md": "Bug Fix",
@@ -47,6 +67,415 @@ TYPE_MAPPING = {
     "security": "security.md"
 }
 
+# analyze_file_changes responses keyed by (cwd, HEAD sha, merge base sha, arguments).
+# The diff between two commits never changes, so a hit can be returned as is.
+_RESULT_CACHE: OrderedDict[tuple, str] = OrderedDict()
+_RESULT_CACHE_SIZE = 32
+
+# Longest single diff line the streaming reader accepts (asyncio's default is 64 KiB)
+_STREAM_LINE_LIMIT = 16 * 1024 * 1024
+
+# Opened repositories, keyed by working directory, so the object database and
+# packfile indexes are loaded once instead of on every git invocation
+_REPO_CACHE: dict[str, pygit2.Repository] = {}
+_REPO_LOCKS: dict[str, asyncio.Lock] = {}
+
+
+def _get_repo(cwd: str) -> pygit2.Repository:
+    """Return a cached pygit2 repository for the given working directory."""
+    repo = _REPO_CACHE.get(cwd)
+    if repo is None:
+        repo_path = pygit2.discover_repository(cwd)
+        if repo_path is None:
+            raise pygit2.GitError(f"Not a git repository: {cwd}")
+        repo = pygit2.Repository(repo_path)
+        _REPO_CACHE[cwd] = repo
+    return repo
+
+
+async def _run_pygit2(repo: pygit2.Repository, func, *args):
+    """Run func(repo, *args) in a worker thread so diffs and revwalks don't block the event loop.
+
+    A Repository isn't safe to use from two threads at once, so calls are serialized per repository.
+    """
+    lock = _REPO_LOCKS.setdefault(repo.path, asyncio.Lock())
+    async with lock:
+        return await asyncio.to_thread(func, repo, *args)
+
+
+def _current_branch(repo: pygit2.Repository) -> str:
+    """Equivalent of `git branch --show-current` (empty when detached)."""
+    if repo.head_is_unborn or repo.head_is_detached:
+        return ""
+    return repo.head.shorthand
+
+
+def _commit_subject(message: str) -> str:
+    """Subject as shown by `git log --oneline`: the first paragraph folded onto one line."""
+    first_paragraph = message.strip().split("\n\n", 1)[0]
+    return " ".join(first_paragraph.split())
+
+
+# C escapes git uses when quoting paths; other bytes that need quoting are written in octal
+_PATH_ESCAPES = {0x07: b"a", 0x08: b"b", 0x09: b"t", 0x0a: b"n", 0x0b: b"v", 0x0c: b"f", 0x0d: b"r", 0x22: b'"', 0x5c: b"\\"}
+
+
+def _quote_path(raw_path: bytes, quote_non_ascii: bool) -> str:
+    """Quote a path the way git does in --raw and --name-status output (see core.quotePath)."""
+    def must_quote(b):
+        return b < 0x20 or b == 0x7f or b in _PATH_ESCAPES or (quote_non_ascii and b >= 0x80)
+
+    if not any(must_quote(b) for b in raw_path):
+        return raw_path.decode(errors="replace")
+    quoted = bytearray(b'"')
+    for b in raw_path:
+        if not must_quote(b):
+            quoted.append(b)
+        elif b in _PATH_ESCAPES:
+            quoted += b"\\" + _PATH_ESCAPES[b]
+        else:
+            quoted += b"\\%03o" % b
+    quoted += b'"'
+    return quoted.decode(errors="replace")
+
+
+def _collect_changes_pygit2(
+    repo: pygit2.Repository, head_sha: str, merge_base_sha: str, include_diff: bool, max_diff_lines: int
+) -> dict:
+    """Collect name-status, stat, patch and log output in-process from one repository."""
+    head = repo[head_sha].peel(pygit2.Commit)
+    merge_base = repo[merge_base_sha].peel(pygit2.Commit)
+
+    # Same trees as `git diff <base>...HEAD`
+    diff = merge_base.tree.diff_to_tree(head.tree, context_lines=3)
+    diff.find_similar()
+
+    try:
+        quote_non_ascii = repo.config.get_bool("core.quotePath")
+    except KeyError:
+        quote_non_ascii = True
+
+    files_changed = ""
+    for delta in diff.deltas:
+        new_path = _quote_path(delta.new_file.raw_path, quote_non_ascii)
+        if delta.status_char() in ("R", "C"):
+            old_path = _quote_path(delta.old_file.raw_path, quote_non_ascii)
+            files_changed += f"{delta.status_char()}{delta.similarity:03d}\t{old_path}\t{new_path}\n"
+        else:
+            files_changed += f"{delta.status_char()}\t{new_path}\n"
+
+    # libgit2 lists paths unquoted and pads them by byte length, so for
+    # non-ASCII paths this differs from `git diff --stat` (as do patch headers
+    # when core.quotePath is off, since libgit2 always quotes them)
+    statistics = diff.stats.format(pygit2.enums.DiffStatsFormat.FULL, 80) if len(diff) else ""
+
+    # Same commits, in the same order, as `git log --oneline <merge base>..HEAD`
+    walker = repo.walk(head.id, pygit2.enums.SortMode.TOPOLOGICAL | pygit2.enums.SortMode.TIME)
+    walker.hide(merge_base.id)
+    commits = "".join(f"{commit.short_id} {_commit_subject(commit.message)}\n" for commit in walker)
+
+    diff_text, total_diff_lines, truncated = _truncate_patches(
+        (patch.text for patch in diff) if include_diff else (), max_diff_lines
+    )
+
+    return {
+        "files_changed": files_changed,
+        "statistics": statistics,
+        "diff": diff_text,
+        "total_diff_lines": total_diff_lines,
+        "truncated": truncated,
+        "commits": commits,
+    }
+
+
+async def _git_async(cwd: str, *args: str) -> tuple[int, str, str]:
+    """Run a git command without blocking the event loop; returns (returncode, stdout, stderr)."""
+    proc = await asyncio.create_subprocess_exec(
+        "git", *args,
+        stdin=asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        cwd=cwd
+    )
+    stdout, stderr = await proc.communicate()
+    return proc.returncode, stdout.decode(errors="replace"), stderr.decode(errors="replace")
+
+
+def _git_error(args: tuple[str, ...], stderr: str) -> str:
+    """Describe a failed git command for the aggregated error response."""
+    return f"git {' '.join(args)}: {stderr.strip()}"
+
+
+async def _git_lines(cwd: str, *args: str, errors: list[str]) -> AsyncIterator[str]:
+    """Run a git command and yield its stdout line by line as it is produced.
+
+    A non-zero exit status is recorded in errors once the output is exhausted.
+    """
+    argv = ["git", *args]
+    proc = await asyncio.create_subprocess_exec(
+        *argv,
+        stdin=asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        limit=_STREAM_LINE_LIMIT,
+        cwd=cwd
+    )
+    try:
+        async for line in proc.stdout:
+            yield line.decode(errors="replace")
+        stderr = (await proc.stderr.read()).decode(errors="replace")
+        await proc.wait()
+    finally:
+        if proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+    if proc.returncode != 0:
+        errors.append(_git_error(args, stderr))
+
+
+def _truncate_diff(diff_text: str, max_diff_lines: int) -> tuple[str, int, bool]:
+    """Cap an in-memory diff at max_diff_lines; returns (content, total_lines, truncated).
+
+    Counts and slices on newline positions instead of splitting into a list of lines.
+    """
+    total_lines = diff_text.count('\n') + 1
+    if total_lines <= max_diff_lines:
+        return diff_text, total_lines, False
+
+    # Cut just before the max_diff_lines-th newline
+    end = 0
+    if max_diff_lines > 0:
+        end = -1
+        for _ in range(max_diff_lines):
+            end = diff_text.find('\n', end + 1)
+    return diff_text[:end], total_lines, True
+
+
+def _truncate_patches(patch_texts: Iterable[str], max_diff_lines: int) -> tuple[str, int, bool]:
+    """_truncate_diff over the concatenated per-file patches, without building the whole diff.
+
+    Patches that start past max_diff_lines are only counted, so memory stays
+    bounded by the kept lines plus the largest single file's patch.
+    """
+    kept = []
+    newlines = 0
+    for text in patch_texts:
+        if newlines < max_diff_lines:
+            kept.append(text)
+        newlines += text.count('\n')
+
+    # kept holds every patch up to the one containing the max_diff_lines-th newline
+    diff_text, _, _ = _truncate_diff("".join(kept), max_diff_lines)
+    total_lines = newlines + 1
+    return diff_text, total_lines, total_lines > max_diff_lines
+
+
+async def _read_diff_stream(lines: AsyncIterable[str], max_diff_lines: int) -> dict:
+    """Parse streamed `git diff --raw --stat --patch` output, keeping at most max_diff_lines of patch.
+
+    Patch lines past the limit are only counted, so memory stays O(max_diff_lines)
+    however large the diff is. Line counts and truncation match _truncate_diff.
+    """
+    files_changed = ""
+    statistics = ""
+    kept_lines = []
+    patch_lines = 0
+    ends_with_newline = False
+    in_patch = False
+
+    async for line in lines:
+        if not in_patch:
+            if line.startswith(":"):
+                # ":<old mode> <new mode> <old sha> <new sha> <status>\t<paths>" -> "<status>\t<paths>"
+                files_changed += line.split(" ", 4)[4]
+                continue
+            if not line.startswith("diff --git "):
+                if line.strip():
+                    statistics += line
+                continue
+            in_patch = True
+
+        patch_lines += 1
+        if patch_lines <= max_diff_lines:
+            kept_lines.append(line)
+        ends_with_newline = line.endswith("\n")
+
+    # Count lines the way str.split('\n') does (a trailing newline adds an empty line)
+    total_diff_lines = patch_lines + 1 if ends_with_newline or not patch_lines else patch_lines
+    truncated = total_diff_lines > max_diff_lines
+    diff_text = "".join(kept_lines)
+    if truncated and diff_text.endswith("\n"):
+        diff_text = diff_text[:-1]
+
+    return {
+        "files_changed": files_changed,
+        "statistics": statistics,
+        "diff": diff_text,
+        "total_diff_lines": total_diff_lines,
+        "truncated": truncated,
+    }
+
+
+async def _collect_changes_subprocess(
+    cwd: str, head_sha: str, merge_base_sha: str, include_diff: bool, max_diff_lines: int, errors: list[str]
+) -> Optional[dict]:
+    """Collect the same output by shelling out to git (used when pygit2 can't open the repo).
+
+    Returns None, with the failures added to errors, if any git command fails.
+    """
+    # Changed files, statistics and (optionally) the patch in one streamed git invocation
+    diff_args = ("diff", "--raw", "--stat", *(("--patch",) if include_diff else ()), merge_base_sha, head_sha)
+
+    # The diff and the commit log are independent, so run both git processes at once
+    log_args = ("log", "--oneline", f"{merge_base_sha}..{head_sha}")
+    changes, log_result = await asyncio.gather(
+        _read_diff_stream(
+            _git_lines(cwd, *diff_args, errors=errors),
+            max_diff_lines
+        ),
+        _git_async(cwd, *log_args),
+        return_exceptions=True
+    )
+
+    # Check every result before using any of them
+    if isinstance(changes, Exception):
+        errors.append(_git_error(diff_args, str(changes)))
+    if isinstance(log_result, Exception):
+        errors.append(_git_error(log_args, str(log_result)))
+    elif log_result[0] != 0:
+        errors.append(_git_error(log_args, log_result[2]))
+    if errors:
+        return None
+
+    changes["commits"] = log_result[1]
+    return changes
+
+
+def _merge_base_pygit2(repo: pygit2.Repository, comparison_base: str) -> tuple[Optional[tuple[str, str]], str]:
+    """(HEAD sha, merge base sha) from the cached repository, or None plus why it can't be resolved."""
+    try:
+        head = repo.head.peel(pygit2.Commit)
+        base = repo.revparse_single(comparison_base).peel(pygit2.Commit)
+    except KeyError:
+        return None, f"{comparison_base}: not a valid revision"
+    except (pygit2.GitError, ValueError) as e:
+        return None, f"{comparison_base}: {e}"
+    merge_base = repo.merge_base(base.id, head.id)
+    if merge_base is None:
+        return None, f"no merge base between HEAD and {comparison_base}"
+    return (str(head.id), str(merge_base)), ""
+
+
+async def _merge_base_subprocess(cwd: str, comparison_base: str) -> tuple[Optional[tuple[str, str]], list[str]]:
+    """(HEAD sha, merge base sha) from git, or None plus a message per failed command."""
+    head_args = ("rev-parse", "HEAD")
+    base_args = ("merge-base", "HEAD", comparison_base)
+    (head_rc, head_sha, head_err), (base_rc, merge_base_sha, base_err) = await asyncio.gather(
+        _git_async(cwd, *head_args),
+        _git_async(cwd, *base_args)
+    )
+
+    failures = []
+    if head_rc != 0:
+        failures.append(_git_error(head_args, head_err))
+    if base_rc != 0:
+        # `git merge-base` exits 1 without output when the histories are unrelated
+        failures.append(_git_error(base_args, base_err or "no merge base found"))
+    if failures:
+        return None, failures
+    return (head_sha.strip(), merge_base_sha.strip()), []
+
+
+async def _resolve_comparison(
+    repo: Optional[pygit2.Repository], cwd: str, comparison_base: str, base_branch: str, errors: list[str]
+) -> Optional[tuple[str, str, str]]:
+    """Pin HEAD and its merge base with the comparison base; returns (head sha, merge base sha, base used).
+
+    A local base branch that doesn't exist falls back to origin/<base_branch>.
+    Returns None, with every failed attempt added to errors, when no candidate resolves.
+    """
+    candidates = [comparison_base]
+    if comparison_base == base_branch:
+        candidates.append(f"origin/{base_branch}")
+
+    failures = []
+    if repo is not None:
+        # The repository is open, so its answer is final; no need to ask git again
+        for candidate in candidates:
+            shas, failure = await _run_pygit2(repo, _merge_base_pygit2, candidate)
+            if shas is not None:
+                return (*shas, candidate)
+            failures.append(failure)
+        errors.extend(failures)
+        return None
+
+    for candidate in candidates:
+        shas, attempt_failures = await _merge_base_subprocess(cwd, candidate)
+        if shas is not None:
+            return (*shas, candidate)
+        failures.extend(attempt_failures)
+    errors.extend(failures)
+    return None
+
+
+def _git_errors_response(errors: list[str]) -> str:
+    """Error response listing every git command that failed."""
+    return json.dumps({"error": f"Git error: {'; '.join(errors)}"})
+
+
+def _cached_result(key: tuple) -> Optional[str]:
+    """Look up a previous analyze_file_changes response, marking it most recently used."""
+    payload = _RESULT_CACHE.get(key)
+    if payload is not None:
+        _RESULT_CACHE.move_to_end(key)
+    return payload
+
+
+def _store_result(key: tuple, payload: str) -> None:
+    """Remember an analyze_file_changes response, evicting the least recently used one."""
+    _RESULT_CACHE[key] = payload
+    _RESULT_CACHE.move_to_end(key)
+    while len(_RESULT_CACHE) > _RESULT_CACHE_SIZE:
+        _RESULT_CACHE.popitem(last=False)
+
+
+async def _list_roots() -> tuple[Optional[ListRootsResult], Optional[str]]:
+    """Ask the MCP client for its roots; returns (result, error message)."""
+    try:
+        context = mcp.get_context()
+        return await context.session.list_roots(), None
+    except Exception as e:
+        return None, str(e)
+
+
+def _debug_info(
+    working_directory: Optional[str],
+    cwd: str,
+    roots_result: Optional[ListRootsResult],
+    roots_error: Optional[str]
+) -> dict:
+    """Describe where the server is running and which roots the client reported."""
+    debug_info = {
+        "provided_working_directory": working_directory,
+        "actual_cwd": cwd,
+        "server_process_cwd": os.getcwd(),
+        "server_file_location": _SERVER_DIR,
+        "roots_check": None
+    }
+
+    # Add roots debug info
+    if roots_result is not None:
+        debug_info["roots_check"] = {
+            "found": True,
+            "count": len(roots_result.roots),
+            "roots":[str(root.uri) for root in roots_result.roots]
+        }
+    else:
+        debug_info["roots_check"] = {
+            "found": False,
+            "error": roots_error
+        }
+    return debug_info
 
 
 # Example structure for a tool:
@@ -70,13 +499,15 @@ async def analyze_file_changes(
     base_branch: str = "main", 
     include_diff: bool = True,
     max_diff_lines: int = 500,
-    working_directory: Optional[str] = None
+    working_directory: Optional[str] = None,
+    debug: bool = False
     ) -> str:
     """Get the full diff and list of changed files in the current git repository.
     
     Args:
         base_branch: Base branch to compare against (default: main)
         include_diff: Include the full diff content (default: true)
+        debug: Include server debug information in the response (default: false)
     """
     # TODO: Implement this tool
     # IMPORTANT: MCP tools have a 25,000 token response limit!
@@ -93,133 +524,110 @@ async def analyze_file_changes(
     # subprocess.run(["git", "diff"], cwd=working_dir)
 
     try:
+        # Ask the client for its roots once; used both for the working directory and the debug output
+        roots_result, roots_error = None, None
+        if working_directory is None or debug:
+            roots_result, roots_error = await _list_roots()
+
         # Try to get working directory from root first
-        if working_directory is None:
-            try:
-                context = mcp.get_context()
-                roots_result = await context.session.list_roots()
-                # Get the first root - Claude Code sets this to the CWD
-                root  = roots_result.roots[0]
-                # FileUrl object has a .path property that gives us the path directly
-                working_directory = root.uri.path
-            except Exception:
-                pass
+        if working_directory is None and roots_result is not None and roots_result.roots:
+            # Get the first root - Claude Code sets this to the CWD
+            root  = roots_result.roots[0]
+            # FileUrl object has a .path property that gives us the path directly
+            working_directory = root.uri.path
     
         # Use provided working directory or current directory
         cwd = working_directory if working_directory else os.getcwd()
 
         # Debug output
-        debug_info = {
-            "provided_working_directory": working_directory,
-            "actual_cwd": cwd,
-            "server_process_cwd": os.getcwd(),
-            "server_file_location": str(Path(__file__).parent),
-            "roots_check": None
-        }
-
+        debug_info = _debug_info(working_directory, cwd, roots_result, roots_error) if debug else None
         
+        # Failed git commands are collected here and reported together
+        errors: list[str] = []
 
-
-        # Add roots debug info
-        try:
-            context = mcp.get_context()
-            roots_result = await context.session.list_roots()
-            debug_info["roots_check"] = {
-                "found": True,
-                "count": len(roots_result.roots),
-                "roots":[str(root.uri) for root in roots_result.roots]
-            }
-        except Exception as e:
-            debug_info["roots_check"] = {
-                "found": False,
-                "error":str(e)
-            }
-        
         # 添加分支检测,允许直接修改主分支并比较修改内容
-        current_branch_result = subprocess.run(
-            ["git", "branch", "--show-current"],
-            capture_output=True,
-            text=True,
-            cwd=cwd
-        )
-
-        current_branch = current_branch_result.stdout.strip()
+        try:
+            repo = await asyncio.to_thread(_get_repo, cwd)
+            current_branch = await _run_pygit2(repo, _current_branch)
+        except pygit2.GitError:
+            repo = None
+            returncode, current_branch, stderr = await _git_async(cwd, "branch", "--show-current")
+            if returncode != 0:
+                errors.append(_git_error(("branch", "--show-current"), stderr))
+                return _git_errors_response(errors)
+            current_branch = current_branch.strip()
 
         if current_branch == base_branch:
             # 当前是main分支,直接和远程分支做对比
             comparison_base = f"origin/{base_branch}"
-            debug_info["comparison_strategy"] = f"On {base_branch} branch, comparing with origin/{base_branch}"
         else:
             # 在功能分支上，与本地main分支比较
             comparison_base = base_branch
-            debug_info["comparison_strategy"] = f"On feature branch '{current_branch}', comparing with {base_branch}"
-        
-        debug_info["current_branch"] = current_branch
-        debug_info["comparison_base"] = comparison_base
-        
-        # Get list of changed files
-        files_result = subprocess.run(
-            ["git", "diff", "--name-status", f"{comparison_base}...HEAD"],
-            capture_output=True,
-            text=True,
-            check=True,
-            cwd=cwd
-            )
-            
-        
 
-        # Get diff statistics
-        stat_result = subprocess.run(
-            ["git", "diff", "--stat", f"{comparison_base}...HEAD"],
-            capture_output=True,
-            text=True,
-            cwd=cwd
-        )
-
-        # Get the actual diff if requested
-        diff_content = ""
-        truncated = False
-        if include_diff:
-            diff_result = subprocess.run(
-                ["git", "diff", f"{comparison_base}...HEAD"],
-                capture_output=True,
-                text=True,
-                cwd=cwd
-            )
-            diff_lines = diff_result.stdout.split('\n')
-
-            # Check if we need to truncate
-            if len(diff_lines) > max_diff_lines:
-                diff_content = '\n'.join(diff_lines[:max_diff_lines])
-                diff_content += f"\n\n... Output truncated. Showing {max_diff_lines} of {len(diff_lines)} lines ..."
-                diff_content += "\n... Use max_diff_lines parameter to see more ..."
-                truncated = True
+        # Resolve the merge base once and pin both commits for every git call below
+        resolved = await _resolve_comparison(repo, cwd, comparison_base, base_branch, errors)
+        if resolved is None:
+            return _git_errors_response(errors)
+        head_sha, merge_base_sha, resolved_base = resolved
+
+        if debug:
+            if current_branch == base_branch:
+                debug_info["comparison_strategy"] = f"On {base_branch} branch, comparing with origin/{base_branch}"
             else:
-                diff_content = diff_result.stdout
-        
-        # Get commit messages for context
-        commits_result = subprocess.run(
-            ["git", "log", "--oneline", f"{comparison_base}...HEAD"],
-            capture_output=True,
-            text=True,
-            cwd=cwd
-        )
+                debug_info["comparison_strategy"] = f"On feature branch '{current_branch}', comparing with {base_branch}"
+            debug_info["current_branch"] = current_branch
+            debug_info["comparison_base"] = resolved_base
+            debug_info["merge_base"] = merge_base_sha
+
+        # Same commits and arguments as an earlier call -> same response (debug output is always fresh)
+        cache_key = None
+        if not debug:
+            cache_key = (cwd, head_sha, merge_base_sha, base_branch, include_diff, max_diff_lines)
+            cached = _cached_result(cache_key)
+            if cached is not None:
+                return cached
+
+        # Read everything from the cached repository; only shell out to git if pygit2 fails
+        changes = None
+        backend = "pygit2"
+        if repo is not None:
+            try:
+                changes = await _run_pygit2(
+                    repo, _collect_changes_pygit2, head_sha, merge_base_sha, include_diff, max_diff_lines
+                )
+            except (pygit2.GitError, KeyError, ValueError):
+                changes = None
+        if changes is None:
+            changes = await _collect_changes_subprocess(cwd, head_sha, merge_base_sha, include_diff, max_diff_lines, errors)
+            if changes is None:
+                return _git_errors_response(errors)
+            backend = "subprocess"
+
+        # Both backends hand back the diff already capped at max_diff_lines
+        diff_content = changes["diff"]
+        truncated = include_diff and changes["truncated"]
+        if truncated:
+            diff_content += f"\n\n... Output truncated. Showing {max_diff_lines} of {changes['total_diff_lines']} lines ..."
+            diff_content += "\n... Use max_diff_lines parameter to see more ..."
 
         analysis = {
             "base_branch": base_branch,
-            "files_changed": files_result.stdout,
-            "statistics": stat_result.stdout,
-            "commits": commits_result.stdout,
+            "files_changed": changes["files_changed"],
+            "statistics": changes["statistics"],
+            "commits": changes["commits"],
             "diff": diff_content if include_diff else "Diff not included (set include_diff=true to see full diff)",
             "truncated": truncated,
-            "total_diff_lines": len(diff_lines) if include_diff else 0,
-            "_debug": debug_info
+            "total_diff_lines": changes["total_diff_lines"] if include_diff else 0
         }
+        if debug:
+            debug_info["backend"] = backend
+            analysis["_debug"] = debug_info
 
-        return json.dumps(analysis, indent=2)
+        result = _dumps(analysis)
+        if cache_key is not None:
+            _store_result(cache_key, result)
+        return result
 
-    except subprocess.CalledProcessError as e:
-        return json.dumps({"error": f"Git error: {e.stderr}"})
     except Exception as e:
         return json.dumps({"error": str(e)})
     
@@ -227,18 +635,95 @@ async def analyze_file_changes(
 
 
 @mcp.tool()
-async def get_pr_templates() -> str:
-    """List available PR templates with their content."""
+async def server_debug_info(working_directory: Optional[str] = None) -> str:
+    """Show the server's working directories and the MCP roots reported by the client.
+    
+    Args:
+        working_directory: Directory analyze_file_changes would be given (default: first root)
+    """
+    roots_result, roots_error = await _list_roots()
+    if working_directory is None and roots_result is not None and roots_result.roots:
+        working_directory = roots_result.roots[0].uri.path
+    cwd = working_directory if working_directory else os.getcwd()
+    return _dumps(_debug_info(working_directory, cwd, roots_result, roots_error))
+
+
+# Templates and the response payloads built from them, loaded on first use so a
+# missing template only fails the template tools, not the whole server
+_TEMPLATES_LOADED = False
+_TEMPLATES: list[dict] = []
+_TEMPLATES_BY_FILENAME: dict[str, dict] = {}
+_TEMPLATES_JSON = "[]"
+
+# suggest_template lookups: change type alias -> template, and per template the
+# serialized response split around the one per-call field ("reasoning")
+_TEMPLATE_BY_TYPE: dict[str, dict] = {}
+_DEFAULT_TEMPLATE: dict = {}
+_SUGGESTION_PARTS: dict[str, tuple[str, str]] = {}
+
+
+def _suggestion_parts(template: dict) -> tuple[str, str]:
+    """Serialize a suggest_template response once, split where the reasoning string goes."""
+    suggestion = {
+        "recommended_template": template,
+        "reasoning": "",
+        "template_content": template["content"],
+        "usage_hint": "Claude can help you fill out this template based on the specific changes in your PR."
+    }
+    # Quotes inside JSON string values are always escaped, so this only matches the key itself
+    prefix, suffix = _dumps(suggestion).split('"reasoning": ""', 1)
+    return prefix + '"reasoning": ', suffix
+
+
+def refresh_templates() -> None:
+    """Re-read the template files from TEMPLATES_DIR (for tests and while editing templates)."""
+    global _TEMPLATES_LOADED, _TEMPLATES, _TEMPLATES_BY_FILENAME, _TEMPLATES_JSON
+    global _TEMPLATE_BY_TYPE, _DEFAULT_TEMPLATE, _SUGGESTION_PARTS
+
+    # One directory sweep instead of resolving a Path per template
+    with os.scandir(TEMPLATES_DIR) as entries:
+        content = {}
+        for entry in entries:
+            if entry.name in DEFAULT_TEMPLATES:
+                with open(entry.path, "rb") as f:
+                    content[entry.name] = f.read().decode()
+
+    missing = [filename for filename in DEFAULT_TEMPLATES if filename not in content]
+    if missing:
+        raise FileNotFoundError(f"PR templates missing from {TEMPLATES_DIR}: {', '.join(missing)}")
+
     templates = [
         {
             "filename": filename,
             "type": template_type,
-            "content": (TEMPLATES_DIR / filename).read_text()
+            "content": content[filename]
         }
         for filename, template_type in DEFAULT_TEMPLATES.items()
     ]
 
-    return json.dumps(templates, indent=2)
+    templates_by_filename = {t["filename"]: t for t in templates}
+
+    _TEMPLATES = templates
+    _TEMPLATES_BY_FILENAME = templates_by_filename
+    _TEMPLATES_JSON = _dumps(templates)
+
+    _TEMPLATE_BY_TYPE = {alias: templates_by_filename[filename] for alias, filename in TYPE_MAPPING.items()}
+    _DEFAULT_TEMPLATE = templates_by_filename.get("feature.md", templates[0])
+    _SUGGESTION_PARTS = {t["filename"]: _suggestion_parts(t) for t in templates}
+    _TEMPLATES_LOADED = True
+
+
+def _ensure_templates() -> None:
+    """Load the templates the first time a template tool needs them."""
+    if not _TEMPLATES_LOADED:
+        refresh_templates()
+
+
+@mcp.tool()
+async def get_pr_templates() -> str:
+    """List available PR templates with their content."""
+    _ensure_templates()
+    return _TEMPLATES_JSON
 
 
 @mcp.tool()
@@ -249,27 +734,15 @@ async def suggest_template(changes_summary: str, change_type: str) -> str:
         changes_summary: Your analysis of what the changes do
         change_type: The type of change you've identified (bug, feature, docs, refactor, test, etc.)
     """
-    
-    # Get available templates
-    templates_response  = await get_pr_templates()
-    templates = json.loads(templates_response)
+    _ensure_templates()
 
     # Find matching template
-    template_file = TYPE_MAPPING.get(change_type.lower(), "feature.md") # 查找字典找到对应的模板
-    
-    selected_template = next(
-        (t for t in templates if t["filename"] == template_file),
-        templates[0] # Default to first template if no match
-    )
-
-    suggestion = {
-        "recommended_template": selected_template,
-        "reasoning": f"Based on your analysis: '{changes_summary}', this appears to be a {change_type} change. ",
-        "template_content": selected_template["content"],
-        "usage_hint": "Claude can help you fill out this template based on the specific changes in your PR."
-    }
-    return json.dumps(suggestion, indent=2)
+    selected_template = _TEMPLATE_BY_TYPE.get(change_type.lower()) or _DEFAULT_TEMPLATE # 查找字典找到对应的模板
 
+    # Only the reasoning depends on the arguments; the rest was serialized at load time
+    prefix, suffix = _SUGGESTION_PARTS[selected_template["filename"]]
+    reasoning = f"Based on your analysis: '{changes_summary}', this appears to be a {change_type} change. "
+    return prefix + _dumps(reasoning) + suffix
 
 if __name__ == "__main__":
     mcp.run()
\ No newline at end of file
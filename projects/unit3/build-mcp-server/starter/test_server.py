@@ -5,10 +5,14 @@ Run these tests to validate your implementation
 """
 
 import json
+import os
+import subprocess
+import pygit2
 import pytest
 import asyncio
 from pathlib import Path
-from unittest.mock import patch, MagicMock
+from contextlib import ExitStack
+from unittest.mock import patch, MagicMock, AsyncMock
 
 # Import your implemented functions
 try:
@@ -16,7 +20,8 @@ try:
         mcp,
         analyze_file_changes,
         get_pr_templates,
-        suggest_template
+        suggest_template,
+        server_debug_info
     )
     IMPORTS_SUCCESSFUL = True
 except ImportError as e:
@@ -24,6 +29,72 @@ except ImportError as e:
     IMPORT_ERROR = str(e)
 
 
+async def _async_lines(lines):
+    """Stand-in for server._git_lines that yields canned git output."""
+    for line in lines:
+        yield line
+
+
+def _subprocess_git(lines):
+    """Force the subprocess backend and feed it canned `git diff` output (a list or a fake _git_lines)."""
+    git_lines = lines if callable(lines) else (lambda *args, **kwargs: _async_lines(lines))
+    stack = ExitStack()
+    stack.enter_context(patch('server._get_repo', side_effect=pygit2.GitError))
+    stack.enter_context(patch('server._resolve_comparison', AsyncMock(return_value=("head-sha", "base-sha", "main"))))
+    stack.enter_context(patch('server._git_async', AsyncMock(return_value=(0, "", ""))))
+    stack.enter_context(patch('server._git_lines', git_lines))
+    stack.enter_context(patch.dict('server._RESULT_CACHE', clear=True))
+    return stack
+
+
+def _make_repo(path):
+    """Create a repo with a `main` base commit and a `feature` branch that modifies, deletes and renames.
+    
+    `feature` also merges a `side` branch whose commit dates interleave with its own,
+    so the commit log order depends on both topology and date.
+    """
+    env = {**os.environ, "GIT_AUTHOR_NAME": "Test", "GIT_AUTHOR_EMAIL": "test@example.com",
+           "GIT_COMMITTER_NAME": "Test", "GIT_COMMITTER_EMAIL": "test@example.com"}
+    
+    def git(*args, day=0):
+        date = f"2024-01-{day + 1:02d}T12:00:00+00:00"
+        subprocess.run(["git", *args], cwd=path, env={**env, "GIT_AUTHOR_DATE": date, "GIT_COMMITTER_DATE": date},
+                       check=True, capture_output=True)
+    
+    def commit(filename, text, day):
+        (path / filename).write_text(text)
+        git("add", "-A")
+        git("commit", "-q", "-m", f"{filename} day {day}", day=day)
+    
+    git("init", "-q", "-b", "main")
+    (path / "keep.txt").write_text("".join(f"line {i}\n" for i in range(20)))
+    (path / "remove.txt").write_text("going away\n")
+    (path / "old_name.txt").write_text("".join(f"moved {i}\n" for i in range(20)))
+    git("add", "-A")
+    git("commit", "-q", "-m", "Initial commit")
+    
+    git("checkout", "-q", "-b", "feature")
+    (path / "keep.txt").write_text("".join(f"line {i}\n" for i in range(20)).replace("line 5\n", "line five\n"))
+    git("rm", "-q", "remove.txt")
+    git("mv", "old_name.txt", "new_name.txt")
+    git("add", "-A")
+    git("commit", "-q", "-m", "Rework files\nacross two lines\n\nBody paragraph", day=1)
+    
+    git("checkout", "-q", "-b", "side", "main")
+    commit("side.txt", "side 2\n", day=2)
+    git("checkout", "-q", "feature")
+    commit("feature.txt", "feature 3\n", day=3)
+    git("checkout", "-q", "side")
+    commit("side.txt", "side 4\n", day=4)
+    git("checkout", "-q", "feature")
+    commit("feature.txt", "feature 5\n", day=5)
+    git("checkout", "-q", "side")
+    commit("side.txt", "side 6\n", day=6)
+    git("checkout", "-q", "feature")
+    git("merge", "-q", "--no-ff", "-m", "Merge side", "side", day=7)
+    git("branch", "-q", "-D", "side")
+
+
 class TestImplementation:
     """Test that the required functions are implemented."""
     
@@ -43,8 +114,7 @@ class TestAnalyzeFileChanges:
     @pytest.mark.asyncio
     async def test_returns_json_string(self):
         """Test that analyze_file_changes returns a JSON string."""
-        with patch('subprocess.run') as mock_run:
-            mock_run.return_value = MagicMock(stdout="", stderr="")
+        with _subprocess_git([]):
             
             result = await analyze_file_changes()
             
@@ -56,8 +126,7 @@ class TestAnalyzeFileChanges:
     @pytest.mark.asyncio
     async def test_includes_required_fields(self):
         """Test that the result includes expected fields."""
-        with patch('subprocess.run') as mock_run:
-            mock_run.return_value = MagicMock(stdout="M\tfile1.py\n", stderr="")
+        with _subprocess_git([":100644 100644 abc1234 def5678 M\tfile1.py\n"]):
             
             result = await analyze_file_changes()
             data = json.loads(result)
@@ -72,6 +141,344 @@ class TestAnalyzeFileChanges:
                 # Starter code - just verify it returns something structured
                 assert isinstance(data, dict), "Should return a JSON object even if not implemented"
 
+    
+    @pytest.mark.asyncio
+    async def test_combined_diff_output_is_split(self):
+        """Test that one `git diff --raw --stat --patch` call fills every field."""
+        combined = (
+            ":100644 100644 abc1234 def5678 M\tfile1.py\n"
+            " file1.py | 2 +-\n"
+            " 1 file changed, 1 insertion(+), 1 deletion(-)\n"
+            "\n"
+            "diff --git a/file1.py b/file1.py\n"
+            "-old\n"
+            "+new\n"
+        )
+        with _subprocess_git(combined.splitlines(keepends=True)):
+            
+            result = await analyze_file_changes(include_diff=True)
+            data = json.loads(result)
+            
+            assert data["files_changed"] == "M\tfile1.py\n"
+            assert data["statistics"].endswith("1 insertion(+), 1 deletion(-)\n")
+            assert data["diff"].startswith("diff --git a/file1.py b/file1.py")
+
+    
+    @pytest.mark.asyncio
+    async def test_streamed_diff_is_capped(self):
+        """Test that a large streamed diff keeps only max_diff_lines lines."""
+        large_diff = ["diff --git a/file1.py b/file1.py\n"] + [f"+ line {i}\n" for i in range(1000)]
+        with _subprocess_git(large_diff):
+            
+            result = await analyze_file_changes(include_diff=True, max_diff_lines=100)
+            data = json.loads(result)
+            
+            assert data["truncated"] == True, "Should indicate truncation"
+            assert data["total_diff_lines"] == 1002
+            assert data["diff"].startswith("".join(large_diff[:100]).rstrip("\n"))
+            assert "Showing 100 of 1002 lines" in data["diff"]
+
+    
+    @pytest.mark.asyncio
+    async def test_repeated_call_is_cached(self):
+        """Test that an unchanged HEAD/base pair reuses the previous response."""
+        calls = []
+        
+        def fake_lines(*args, **kwargs):
+            calls.append(args)
+            return _async_lines([":100644 100644 abc1234 def5678 M\tfile1.py\n"])
+        
+        with _subprocess_git(fake_lines):
+            first = await analyze_file_changes(working_directory="/cached/repo")
+            second = await analyze_file_changes(working_directory="/cached/repo")
+        
+        assert first == second
+        assert len(calls) == 1, "Second call should not run git diff again"
+        assert calls[0][-2:] == ("base-sha", "head-sha"), "git diff should use the pinned merge base and HEAD"
+
+    
+    @pytest.mark.asyncio
+    async def test_roots_listed_once(self):
+        """Test that MCP roots are fetched once for both the cwd and the debug output."""
+        root = MagicMock()
+        root.uri.path = "/client/repo"
+        context = MagicMock()
+        context.session.list_roots = AsyncMock(return_value=MagicMock(roots=[root]))
+        
+        with patch.object(mcp, 'get_context', return_value=context), _subprocess_git([]):
+            result = await analyze_file_changes(debug=True)
+        
+        data = json.loads(result)
+        assert context.session.list_roots.await_count == 1
+        assert data["_debug"]["actual_cwd"] == "/client/repo"
+        assert data["_debug"]["roots_check"]["count"] == 1
+
+    
+    @pytest.mark.asyncio
+    async def test_debug_info_is_opt_in(self):
+        """Test that _debug is only included when requested."""
+        with _subprocess_git([]):
+            plain = json.loads(await analyze_file_changes(working_directory="/some/repo"))
+            debug = json.loads(await analyze_file_changes(working_directory="/some/repo", debug=True))
+        
+        assert "_debug" not in plain
+        assert debug["_debug"]["actual_cwd"] == "/some/repo"
+        assert debug["_debug"]["backend"] == "subprocess"
+    
+    @pytest.mark.asyncio
+    async def test_server_debug_info(self):
+        """Test that server_debug_info reports the directory it would use."""
+        data = json.loads(await server_debug_info(working_directory="/some/repo"))
+        
+        assert data["actual_cwd"] == "/some/repo"
+        assert data["roots_check"]["found"] == False, "No MCP session outside a request"
+
+    
+    @pytest.mark.asyncio
+    async def test_failed_git_command_is_reported(self):
+        """Test that a failing git log is returned as an error instead of an empty field."""
+        async def fake_git(cwd, *args):
+            return (128, "", "fatal: bad revision") if args[0] == "log" else (0, "", "")
+        
+        with _subprocess_git([":100644 100644 abc1234 def5678 M\tfile1.py\n"]), \
+             patch('server._git_async', fake_git):
+            result = await analyze_file_changes(working_directory="/some/repo")
+        
+        data = json.loads(result)
+        assert "files_changed" not in data
+        assert data["error"] == "Git error: git log --oneline base-sha..head-sha: fatal: bad revision"
+    
+    @pytest.mark.asyncio
+    async def test_stream_failure_names_full_command(self):
+        """Test that a diff stream that raises is reported with the exact git command that ran."""
+        async def broken_lines(*args, **kwargs):
+            raise OSError("spawn failed")
+            yield
+        
+        with _subprocess_git(broken_lines):
+            result = await analyze_file_changes(working_directory="/some/repo", include_diff=True)
+        
+        assert json.loads(result)["error"] == (
+            "Git error: git diff --raw --stat --patch base-sha head-sha: spawn failed"
+        )
+
+
+@pytest.mark.skipif(not IMPORTS_SUCCESSFUL, reason="Imports failed")
+class TestGitBackends:
+    """Run analyze_file_changes against a real repository with both backends."""
+    
+    @pytest.mark.asyncio
+    async def test_pygit2_backend_output(self, tmp_path):
+        """Test the in-process pygit2 backend's rendering of a real diff."""
+        _make_repo(tmp_path)
+        with patch.dict('server._RESULT_CACHE', clear=True):
+            data = json.loads(await analyze_file_changes(working_directory=str(tmp_path), debug=True))
+        
+        assert data["_debug"]["backend"] == "pygit2"
+        assert data["_debug"]["current_branch"] == "feature"
+        assert data["files_changed"] == (
+            "A\tfeature.txt\n"
+            "M\tkeep.txt\n"
+            "R100\told_name.txt\tnew_name.txt\n"
+            "D\tremove.txt\n"
+            "A\tside.txt\n"
+        )
+        assert data["statistics"].endswith("5 files changed, 3 insertions(+), 2 deletions(-)\n")
+        assert "old_name.txt => new_name.txt" in data["statistics"]
+        assert [line.split(" ", 1)[1] for line in data["commits"].splitlines()] == [
+            "Merge side",
+            "side.txt day 6",
+            "feature.txt day 5",
+            "side.txt day 4",
+            "feature.txt day 3",
+            "side.txt day 2",
+            "Rework files across two lines",
+        ]
+        assert data["diff"].startswith("diff --git a/feature.txt b/feature.txt")
+        assert "+line five" in data["diff"]
+    
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize("branch", ["feature", "fresh"])
+    async def test_backends_match(self, tmp_path, branch):
+        """Test that the pygit2 and subprocess backends return the same analysis (fresh: nothing changed)."""
+        _make_repo(tmp_path)
+        if branch == "fresh":
+            subprocess.run(["git", "checkout", "-q", "-b", "fresh", "main"], cwd=tmp_path, check=True)
+        with patch.dict('server._RESULT_CACHE', clear=True):
+            in_process = json.loads(await analyze_file_changes(working_directory=str(tmp_path), debug=True))
+            with patch('server._get_repo', side_effect=pygit2.GitError):
+                shelled = json.loads(await analyze_file_changes(working_directory=str(tmp_path), debug=True))
+        
+        assert in_process.pop("_debug")["backend"] == "pygit2"
+        assert shelled.pop("_debug")["backend"] == "subprocess"
+        assert in_process == shelled
+        if branch == "fresh":
+            assert in_process["files_changed"] == in_process["statistics"] == in_process["commits"] == ""
+
+    
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize("max_diff_lines", [0, 1, 6, 7, 8, 20, 38, 39, 1000])
+    async def test_capped_diff_matches(self, tmp_path, max_diff_lines):
+        """Test that the per-file pygit2 patches are capped exactly like the streamed git diff."""
+        _make_repo(tmp_path)
+        with patch.dict('server._RESULT_CACHE', clear=True):
+            in_process = json.loads(await analyze_file_changes(
+                working_directory=str(tmp_path), max_diff_lines=max_diff_lines, debug=True))
+            with patch('server._get_repo', side_effect=pygit2.GitError):
+                shelled = json.loads(await analyze_file_changes(
+                    working_directory=str(tmp_path), max_diff_lines=max_diff_lines, debug=True))
+        
+        assert in_process["truncated"] == (max_diff_lines < 39)
+        for field in ("diff", "total_diff_lines", "truncated"):
+            assert in_process[field] == shelled[field]
+    
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize("quote_path", ["true", "false"])
+    async def test_non_ascii_paths(self, tmp_path, quote_path):
+        """Test that paths are quoted like git in files_changed; statistics keeps libgit2's unquoted paths."""
+        _make_repo(tmp_path)
+        (tmp_path / "ün.txt").write_text("umlaut\n")
+        (tmp_path / 'q"t.txt').write_text("quote\n")
+        for args in (["config", "core.quotePath", quote_path], ["add", "-A"],
+                     ["-c", "user.name=Test", "-c", "user.email=test@example.com", "commit", "-q", "-m", "Odd names"]):
+            subprocess.run(["git", *args], cwd=tmp_path, check=True)
+        
+        with patch.dict('server._RESULT_CACHE', clear=True):
+            in_process = json.loads(await analyze_file_changes(working_directory=str(tmp_path), debug=True))
+            with patch('server._get_repo', side_effect=pygit2.GitError):
+                shelled = json.loads(await analyze_file_changes(working_directory=str(tmp_path), debug=True))
+        
+        umlaut = '"\\303\\274n.txt"' if quote_path == "true" else "ün.txt"
+        assert f"A\t{umlaut}\n" in in_process["files_changed"]
+        assert 'A\t"q\\"t.txt"\n' in in_process["files_changed"]
+        assert in_process["files_changed"] == shelled["files_changed"]
+        # libgit2 quotes non-ASCII patch headers whatever core.quotePath says
+        assert 'diff --git "a/\\303\\274n.txt" "b/\\303\\274n.txt"' in in_process["diff"]
+        assert (in_process["diff"] == shelled["diff"]) == (quote_path == "true")
+        assert " ün.txt " in in_process["statistics"]
+        assert f" {umlaut} " in shelled["statistics"]
+    
+    @pytest.mark.asyncio
+    async def test_non_utf8_path(self, tmp_path):
+        """Test that a path that isn't valid UTF-8 still gets a full analysis from both backends."""
+        _make_repo(tmp_path)
+        (tmp_path / os.fsdecode(b"bad\xff.txt")).write_bytes(b"caf\xe9\n")
+        for args in (["add", "-A"], ["-c", "user.name=Test", "-c", "user.email=test@example.com", "commit", "-q", "-m", "Bad name"]):
+            subprocess.run(["git", *args], cwd=tmp_path, check=True)
+        
+        with patch.dict('server._RESULT_CACHE', clear=True):
+            in_process = json.loads(await analyze_file_changes(working_directory=str(tmp_path), debug=True))
+            with patch('server._get_repo', side_effect=pygit2.GitError):
+                shelled = json.loads(await analyze_file_changes(working_directory=str(tmp_path), debug=True))
+        
+        assert 'A\t"bad\\377.txt"\n' in in_process["files_changed"]
+        assert in_process["files_changed"] == shelled["files_changed"]
+        assert in_process["diff"] == shelled["diff"]
+    
+    @pytest.mark.asyncio
+    async def test_pygit2_work_does_not_block_event_loop(self, tmp_path):
+        """Test that other coroutines keep running while the pygit2 diff is computed."""
+        import time
+        import server
+        _make_repo(tmp_path)
+        real_collect = server._collect_changes_pygit2
+        
+        def slow_collect(*args):
+            time.sleep(0.3)
+            return real_collect(*args)
+        
+        ticks = 0
+        
+        async def ticker():
+            nonlocal ticks
+            for _ in range(5):
+                await asyncio.sleep(0.02)
+                ticks += 1
+        
+        async def analyze():
+            result = await analyze_file_changes(working_directory=str(tmp_path))
+            return result, ticks
+        
+        with patch.dict('server._RESULT_CACHE', clear=True), patch('server._collect_changes_pygit2', slow_collect):
+            (result, ticks_during_analysis), _ = await asyncio.gather(analyze(), ticker())
+        
+        assert "files_changed" in json.loads(result)
+        assert ticks_during_analysis == 5, "Event loop should keep running during the pygit2 diff"
+
+
+def _canned_git(responses):
+    """Fake server._git_async answering from {args tuple: (returncode, stdout, stderr)}."""
+    async def fake_git(cwd, *args):
+        return responses[args]
+    return fake_git
+
+
+@pytest.mark.skipif(not IMPORTS_SUCCESSFUL, reason="Imports failed")
+class TestResolveComparison:
+    """Test how the comparison base and merge base are resolved."""
+    
+    @pytest.mark.asyncio
+    async def test_falls_back_to_origin_base(self):
+        """Test that a missing local base branch is retried as origin/<base>."""
+        import server
+        responses = {
+            ("rev-parse", "HEAD"): (0, "head-sha\n", ""),
+            ("merge-base", "HEAD", "main"): (128, "", "fatal: Not a valid object name main\n"),
+            ("merge-base", "HEAD", "origin/main"): (0, "base-sha\n", ""),
+        }
+        errors = []
+        with patch('server._git_async', _canned_git(responses)):
+            resolved = await server._resolve_comparison(None, "/repo", "main", "main", errors)
+        
+        assert resolved == ("head-sha", "base-sha", "origin/main")
+        assert errors == []
+    
+    @pytest.mark.asyncio
+    async def test_unrelated_history(self):
+        """Test that `git merge-base` exiting 1 with no output is reported as no merge base."""
+        import server
+        responses = {
+            ("rev-parse", "HEAD"): (0, "head-sha\n", ""),
+            ("merge-base", "HEAD", "origin/main"): (1, "", ""),
+        }
+        errors = []
+        with patch('server._git_async', _canned_git(responses)):
+            resolved = await server._resolve_comparison(None, "/repo", "origin/main", "main", errors)
+        
+        assert resolved is None
+        assert errors == ["git merge-base HEAD origin/main: no merge base found"]
+    
+    @pytest.mark.asyncio
+    async def test_every_failed_candidate_is_reported(self):
+        """Test that the error response lists both the local and the origin attempt."""
+        responses = {
+            ("branch", "--show-current"): (0, "feature\n", ""),
+            ("rev-parse", "HEAD"): (0, "head-sha\n", ""),
+            ("merge-base", "HEAD", "main"): (128, "", "fatal: Not a valid object name main\n"),
+            ("merge-base", "HEAD", "origin/main"): (128, "", "fatal: Not a valid object name origin/main\n"),
+        }
+        with patch('server._get_repo', side_effect=pygit2.GitError), \
+             patch('server._git_async', _canned_git(responses)):
+            result = await analyze_file_changes(working_directory="/repo")
+        
+        assert json.loads(result) == {
+            "error": "Git error: git merge-base HEAD main: fatal: Not a valid object name main; "
+                     "git merge-base HEAD origin/main: fatal: Not a valid object name origin/main"
+        }
+    
+    @pytest.mark.asyncio
+    async def test_pygit2_failure_does_not_spawn_git(self, tmp_path):
+        """Test that an unresolvable base in an open repository is reported without running git."""
+        _make_repo(tmp_path)
+        git_async = AsyncMock()
+        with patch('server._git_async', git_async):
+            result = await analyze_file_changes(working_directory=str(tmp_path), base_branch="nope")
+        
+        assert json.loads(result) == {
+            "error": "Git error: nope: not a valid revision; origin/nope: not a valid revision"
+        }
+        git_async.assert_not_awaited()
+
 
 @pytest.mark.skipif(not IMPORTS_SUCCESSFUL, reason="Imports failed")
 class TestGetPRTemplates:
@@ -115,6 +522,54 @@ class TestGetPRTemplates:
             # Starter code - just verify it's structured correctly
             assert isinstance(templates, dict), "Should return structured error for starter code"
 
+    
+    @pytest.mark.asyncio
+    async def test_refresh_templates_reloads_files(self, tmp_path):
+        """Test that refresh_templates picks up edited template files."""
+        import server
+        for filename in server.DEFAULT_TEMPLATES:
+            (tmp_path / filename).write_text(f"original {filename}")
+        
+        try:
+            with patch('server.TEMPLATES_DIR', tmp_path):
+                server.refresh_templates()
+                first = json.loads(await get_pr_templates())
+                (tmp_path / "bug.md").write_text("edited bug.md")
+                unchanged = json.loads(await get_pr_templates())
+                server.refresh_templates()
+                second = json.loads(await get_pr_templates())
+        finally:
+            server.refresh_templates()
+        
+        assert first[0]["content"] == "original bug.md"
+        assert unchanged[0]["content"] == "original bug.md", "Templates are served from memory"
+        assert second[0]["content"] == "edited bug.md"
+    
+    def test_server_imports_without_templates(self, tmp_path):
+        """Test that a missing templates directory doesn't stop the server from importing."""
+        import sys
+        import shutil
+        shutil.copy(Path(__file__).parent / "server.py", tmp_path / "server.py")
+        
+        result = subprocess.run([sys.executable, "-c", "import server"], cwd=tmp_path, capture_output=True, text=True)
+        
+        assert result.returncode == 0, result.stderr
+    
+    @pytest.mark.asyncio
+    async def test_missing_template_fails_template_tools_only(self, tmp_path):
+        """Test that a missing template file is reported when the templates are first used."""
+        import server
+        (tmp_path / "bug.md").write_text("only one template")
+        
+        try:
+            with patch('server.TEMPLATES_DIR', tmp_path), patch('server._TEMPLATES_LOADED', False):
+                with pytest.raises(FileNotFoundError, match="feature.md"):
+                    await get_pr_templates()
+                with pytest.raises(FileNotFoundError):
+                    await suggest_template("Fixed a bug", "bug")
+        finally:
+            server.refresh_templates()
+
 
 @pytest.mark.skipif(not IMPORTS_SUCCESSFUL, reason="Imports failed")
 class TestSuggestTemplate:
@@ -152,6 +607,62 @@ class TestSuggestTemplate:
             # Starter code - just verify it's structured correctly
             assert isinstance(suggestion, dict), "Should return structured error for starter code"
 
+    
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize("change_type, filename", [("Bug", "bug.md"), ("unheard-of", "feature.md")])
+    async def test_matches_full_serialization(self, change_type, filename):
+        """Test that the pre-serialized response is identical to serializing the whole suggestion."""
+        import server
+        summary = 'Quoted "reasoning": "" and \\ backslashes, ünïcödé 修复 ✓'
+        template = json.loads(await get_pr_templates())[list(server.DEFAULT_TEMPLATES).index(filename)]
+        expected = server._dumps({
+            "recommended_template": template,
+            "reasoning": f"Based on your analysis: '{summary}', this appears to be a {change_type} change. ",
+            "template_content": template["content"],
+            "usage_hint": "Claude can help you fill out this template based on the specific changes in your PR."
+        })
+        
+        assert await suggest_template(summary, change_type) == expected
+    
+    @pytest.mark.asyncio
+    async def test_lone_surrogate_in_summary(self):
+        """Test that a summary orjson can't encode is still serialized (by the stdlib fallback)."""
+        suggestion = json.loads(await suggest_template("x\ud800", "bug"))
+        
+        assert suggestion["reasoning"].startswith("Based on your analysis: 'x\ud800'")
+        assert suggestion["recommended_template"]["filename"] == "bug.md"
+
+
+@pytest.mark.skipif(not IMPORTS_SUCCESSFUL, reason="Imports failed")
+class TestSerialization:
+    """Test the JSON serialization of tool responses, with and without orjson."""
+    
+    def test_unencodable_strings_use_stdlib(self):
+        """Test that strings orjson rejects fall back to json.dumps output."""
+        import server
+        obj = {"path": "bad\udcff.txt"}
+        
+        assert server._dumps(obj) == json.dumps(obj, indent=2)
+    
+    @pytest.mark.asyncio
+    async def test_server_without_orjson(self, tmp_path):
+        """Test that a server imported without orjson returns the same responses via the stdlib."""
+        import sys
+        import importlib.util
+        spec = importlib.util.spec_from_file_location("server_without_orjson", Path(__file__).parent / "server.py")
+        stdlib_server = importlib.util.module_from_spec(spec)
+        with patch.dict(sys.modules, {"orjson": None}):
+            spec.loader.exec_module(stdlib_server)
+        _make_repo(tmp_path)
+        
+        assert "orjson" not in vars(stdlib_server)
+        suggestion = await stdlib_server.suggest_template("Fixed \"it\" ü \ud800", "bug")
+        assert suggestion == json.dumps(json.loads(suggestion), indent=2)
+        assert json.loads(suggestion) == json.loads(await suggest_template("Fixed \"it\" ü \ud800", "bug"))
+        with patch.dict('server._RESULT_CACHE', clear=True):
+            analysis = await stdlib_server.analyze_file_changes(working_directory=str(tmp_path))
+            assert analysis == json.dumps(json.loads(analysis), indent=2)
+            assert json.loads(analysis) == json.loads(await analyze_file_changes(working_directory=str(tmp_path)))
 
 @pytest.mark.skipif(not IMPORTS_SUCCESSFUL, reason="Imports failed")
 class TestToolRegistration: